@@ -1,6 +1,5 @@
 import numpy as np
 import random
-from collections import namedtuple, deque
 
 from model import QNetwork
 
@@ -9,18 +8,64 @@ import torch.nn.functional as F
 import torch.optim as optim
 
 BUFFER_SIZE = int(1e5)  # replay buffer size
-BATCH_SIZE = 64         # minibatch size
+BATCH_SIZE = 256        # minibatch size
 GAMMA = 0.99            # discount factor
 TAU = 1e-3              # for soft update of target parameters
 LR = 5e-4               # learning rate 
 UPDATE_EVERY = 4        # how often to update the network
+UPLOAD_EVERY = 2000     # how many experiences are staged on the host before moving them to the device
+                        # (CUDA replay memory only): learning starts once the first block is uploaded,
+                        # and up to UPLOAD_EVERY - 1 of the newest experiences cannot be sampled yet
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# Allow TF32 tensor cores for fp32 matmuls and let cuDNN pick the fastest kernels
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+# Run the hidden layers of the learn() forwards in bfloat16 on GPUs that support it
+# (no loss scaling needed); QNetwork keeps its output layer in fp32
+use_amp = device.type == 'cuda' and torch.cuda.is_bf16_supported()
+# torch.compile needs torch >= 2.0 and, for its Triton kernels, a GPU of compute capability 7.0 or newer;
+# otherwise the eager modules are used
+use_compile = (device.type == 'cuda' and hasattr(torch, 'compile')
+               and torch.cuda.get_device_capability(device) >= (7, 0))
+
+
+def q_loss(qnetwork_local, qnetwork_target, states, actions, rewards, next_states, not_dones, gamma):
+    """ DQN loss as a single function, so torch.compile can fuse the target max,
+        the Q-value gather and the target computation into the network kernels.
+
+        INPUTS:
+        ------------
+            qnetwork_local - (PyTorch model) network being trained
+            qnetwork_target - (PyTorch model) network providing the Q targets
+            states, actions, rewards, next_states, not_dones - (torch tensor) sampled batch
+            gamma - (float) discount factor
+
+        OUTPUTS:
+        ------------
+            loss - (torch tensor) mean squared TD error
+    """
+    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_amp):
+        # Get max predicted Q values (for next states) from target model
+        with torch.no_grad():
+            Q_targets_next = qnetwork_target(next_states).max(1, keepdim=True).values
+
+        # Compute Q targets for current states (network outputs are fp32)
+        Q_targets = torch.addcmul(rewards, Q_targets_next, not_dones.to(rewards.dtype), value=gamma)
+
+        # Get expected Q values from local model
+        Q_expected = qnetwork_local(states).gather(1, actions)
+
+        # Compute loss
+        loss = F.mse_loss(Q_expected, Q_targets)
+    return loss
+
 
 class Agent():
     """ Interacts with and learns from the environment."""
 
-    def __init__(self, state_size, action_size, seed):
+    def __init__(self, state_size, action_size, seed, store_device=None):
         """ Initialize an Agent object.
         
             INPUTS: 
@@ -28,6 +73,8 @@ class Agent():
                 state_size - (int) dimension of each state
                 action_size - (int) dimension of each action
                 seed - (int) random seed
+                store_device - (torch device or str) where the replay memory is kept,
+                               defaults to the training device ('cpu' saves device memory)
             
             OUTPUTS:
             ------------
@@ -41,10 +88,32 @@ class Agent():
         # Q-Network
         self.qnetwork_local = QNetwork(state_size, action_size, seed).to(device)
         self.qnetwork_target = QNetwork(state_size, action_size, seed).to(device)
-        self.optimizer = optim.Adam(self.qnetwork_local.parameters(), lr=LR)
+        # Fused Adam updates all parameters in a single CUDA kernel
+        adam_kwargs = {'fused': True} if device.type == 'cuda' else {}
+        self.optimizer = optim.Adam(self.qnetwork_local.parameters(), lr=LR, **adam_kwargs)
+        # Parameter lists for the fused soft update
+        self.local_params = list(self.qnetwork_local.parameters())
+        self.target_params = list(self.qnetwork_target.parameters())
+        # Compiled forward (CUDA graphs) for act() and compiled loss for learn(); the plain
+        # modules are kept so state_dict() keys stay compatible with saved checkpoints
+        if use_compile:
+            self.q_local = torch.compile(self.qnetwork_local, mode='reduce-overhead')
+            self.loss_fn = torch.compile(q_loss)
+        else:
+            self.q_local = self.qnetwork_local
+            self.loss_fn = q_loss
+
+        # Reusable state tensor for act(), filled from a pinned host copy on CUDA
+        self.act_state = torch.empty((1, state_size), dtype=torch.float32, device=device)
+        if device.type == 'cuda':
+            self.act_host = torch.empty((1, state_size), dtype=torch.float32, pin_memory=True)
+        else:
+            self.act_host = self.act_state
+        self.act_host_np = self.act_host.numpy()
 
         # Replay memory
-        self.memory = ReplayBuffer(action_size, BUFFER_SIZE, BATCH_SIZE, seed)
+        store_device = device if store_device is None else torch.device(store_device)
+        self.memory = ReplayBuffer(state_size, action_size, BUFFER_SIZE, BATCH_SIZE, seed, UPLOAD_EVERY, store_device)
         # Initialize time step (for updating every UPDATE_EVERY steps)
         self.t_step = 0
     
@@ -88,16 +157,18 @@ class Agent():
             ------------
                 act_select - (int) next epsilon-greedy action selection
         """
-        state = torch.from_numpy(state).float().unsqueeze(0).to(device)
-      
-        self.qnetwork_local.eval()
-        with torch.no_grad():
-            action_values = self.qnetwork_local(state)
-        self.qnetwork_local.train()
-
         # Epsilon-greedy action selection
         if random.random() > eps:
-            act_select = np.argmax(action_values.cpu().data.numpy())
+            self.act_host_np[0] = state
+            if self.act_host is not self.act_state:
+                self.act_state.copy_(self.act_host, non_blocking=True)
+
+            # QNetwork has no dropout/batchnorm, so no eval()/train() switch is needed
+            with torch.no_grad():
+                action_values = self.q_local(self.act_state)
+
+            # item() waits for the copy, so the host buffer is free for the next call
+            act_select = int(torch.argmax(action_values, dim=1).item())
             return act_select
         else:
             act_select = random.choice(np.arange(self.action_size))
@@ -108,47 +179,33 @@ class Agent():
 
             INPUTS:
             ------------
-                experiences - (Tuple[torch.Variable]) tuple of (s, a, r, s', done) tuples 
+                experiences - (Tuple[torch.Variable]) tuple of (s, a, r, s', 1 - done) tuples 
                 gamma - (float) discount factor
 
             OUTPUTS:
             ------------
         """
-        states, actions, rewards, next_states, dones = experiences
+        states, actions, rewards, next_states, not_dones = experiences
 
         ## Compute and minimize the loss
-        
-        # Get max predicted Q values (for next states) from target model
-        Q_targets_next = self.qnetwork_target(next_states).detach().max(1)[0].unsqueeze(1)
-        #print(Q_targets_next)
-        
-        # Compute Q targets for current states 
-        Q_targets = rewards + (gamma * Q_targets_next * (1 - dones))
-        #print(Q_targets)
-        
-        # Get expected Q values from local model
-        Q_expected = self.qnetwork_local(states).gather(1, actions)
-        #print(Q_expected)
+        loss = self.loss_fn(self.qnetwork_local, self.qnetwork_target,
+                            states, actions, rewards, next_states, not_dones, gamma)
 
-        # Compute loss
-        loss = F.mse_loss(Q_expected, Q_targets)
         # Minimize the loss
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
         loss.backward()
         self.optimizer.step()
         
 
         # ------------------- update target network ------------------- #
-        self.soft_update(self.qnetwork_local, self.qnetwork_target, TAU)                     
+        self.soft_update(TAU)                     
 
-    def soft_update(self, local_model, target_model, tau):
-        """ Soft update model parameters.
+    def soft_update(self, tau):
+        """ Soft update model parameters, one fused kernel per operation over all tensors.
             θ_target = τ*θ_local + (1 - τ)*θ_target
 
             INPUTS:
             ------------
-                local_model - (PyTorch model) weights will be copied from
-                target_model - (PyTorch model) weights will be copied to
                 tau - (float) interpolation parameter 
                 
             OUTPUTS:
@@ -156,36 +213,101 @@ class Agent():
                 no direct
                 
         """
-        for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
-            target_param.data.copy_(tau*local_param.data + (1.0-tau)*target_param.data)
+        with torch.no_grad():
+            torch._foreach_mul_(self.target_params, 1.0 - tau)
+            torch._foreach_add_(self.target_params, self.local_params, alpha=tau)
 
 
 class ReplayBuffer:
-    """ Fixed-size buffer to store experience tuples.
+    """ Fixed-size circular buffer to store experience tuples.
+        Each field is kept in its own pre-allocated tensor on the storage device.
+        By default that is the training device, so sampling needs no host to device
+        copies; storing on the CPU instead trades a copy per batch for device memory.
+        States live in a single observation ring: the next state of experience i is
+        the state stored at i + 1, so it is not kept twice. When an episode stops
+        without done (e.g. a time limit), its last next state is kept in a gap slot
+        that holds no experience of its own. Gap slots take up buffer space, so fewer
+        than buffer_size experiences may be stored; len() counts experiences only and
+        sample() redraws indices that land on a gap.
+        With CUDA storage, new experiences are staged on the host and uploaded in
+        blocks to amortize the transfer overhead; CPU storage is written directly.
     """
 
-    def __init__(self, action_size, buffer_size, batch_size, seed):
+    def __init__(self, state_size, action_size, buffer_size, batch_size, seed, block_size, store_device=device):
         """ Initialize a ReplayBuffer object.
 
         INPUTS:
         ------------
+            state_size - (int) dimension of each state
             action_size - (int) dimension of each action
             buffer_size - (int) maximum size of buffer
             batch_size - (int) size of each training batch
             seed - (int) random seed
+            block_size - (int) number of experiences staged on the host per upload (CUDA storage only)
+            store_device - (torch device) where the experiences are kept, batches are moved to device
             
         OUTPUTS:
         ------------
             no direct
         """
         self.action_size = action_size
-        self.memory = deque(maxlen=buffer_size)  
+        self.buffer_size = buffer_size
         self.batch_size = batch_size
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
+        self.block_size = block_size
+        self.store_device = store_device
         self.seed = random.seed(seed)
+        torch.manual_seed(seed)
+
+        # Pre-allocated storage, one tensor per field, in the smallest dtype that holds it;
+        # obs has one extra row for the next state of the last experience
+        self.obs = torch.empty((buffer_size + 1, state_size), dtype=torch.float32, device=store_device)
+        self.actions = torch.empty(buffer_size, dtype=torch.int64, device=store_device)
+        self.rewards = torch.empty(buffer_size, dtype=torch.float32, device=store_device)
+        self.not_dones = torch.empty(buffer_size, dtype=torch.uint8, device=store_device)
+        self.gaps = torch.zeros(buffer_size, dtype=torch.uint8, device=store_device)
+        self.storage = (self.obs, self.actions, self.rewards, self.not_dones, self.gaps)
+        # Pre-allocated tensors each sampled batch is gathered into (pinned, if the batch
+        # is then copied to a CUDA device, so the transfer runs asynchronously)
+        pin = store_device.type == 'cpu' and device.type == 'cuda'
+        self.batch = tuple(torch.empty((batch_size,) + buf.shape[1:], dtype=buf.dtype,
+                                       device=store_device, pin_memory=pin)
+                           for buf in (self.obs, self.actions, self.rewards, self.obs, self.not_dones))
+        # Marks when the last transfer has finished reading the batch tensors
+        self.transfer_done = torch.cuda.Event() if pin else None
+
+        # Experiences are written through NumPy views to keep add() cheap: into a pinned
+        # host staging block when stored on CUDA, straight into the storage otherwise
+        self.stage = store_device.type == 'cuda'
+        if self.stage:
+            self.staged = tuple(torch.empty((block_size + 1 if buf is self.obs else block_size,) + buf.shape[1:],
+                                            dtype=buf.dtype, pin_memory=True)
+                                for buf in self.storage)
+            self.staged_np = tuple(t.numpy() for t in self.staged)
+            # Marks when the last upload has finished reading the staging block
+            self.upload_done = torch.cuda.Event()
+            # Host copy of the gap flags, to count gaps without reading device memory
+            self.gaps_host = np.zeros(buffer_size, dtype=np.uint8)
+        else:
+            self.storage_np = tuple(buf.numpy() for buf in self.storage)
+            self.gaps_host = self.storage_np[-1]
+        self.n_staged = 0
+        # Number of gap slots in storage
+        self.n_gaps = 0
+
+        # Last next_state and done passed to add(), to detect episodes stopped without done
+        self.last_next_state = None
+        self.last_done = True
+
+        # Next write position and number of stored experiences
+        self.ptr = 0
+        self.size = 0
     
     def add(self, state, action, reward, next_state, done):
-        """ Add a new experience to memory.
+        """ Add a new experience to memory, overwriting the oldest one when full.
+            With CUDA storage, the experience becomes available for sampling once its block is uploaded.
+            Consecutive calls normally chain (state equals the previous next_state). After
+            done the next state is masked anyway and gets overwritten; if the chain breaks
+            without done, the previous next state is kept in a gap slot first.
             
             INPUTS:
             ------------
@@ -200,11 +322,128 @@ class ReplayBuffer:
                 no direct
         
         """
-        e = self.experience(state, action, reward, next_state, done)
-        self.memory.append(e)
+        if not self.last_done and not np.array_equal(state, self.last_next_state):
+            (obs, actions, rewards, not_dones, gaps), i = self.write_slot()
+            obs[i] = self.last_next_state
+            gaps[i] = 1
+            self.advance()
+
+        (obs, actions, rewards, not_dones, gaps), i = self.write_slot()
+        obs[i] = state
+        obs[i + 1] = next_state
+        actions[i] = action
+        rewards[i] = reward
+        not_dones[i] = not done
+        gaps[i] = 0
+        self.advance()
+
+        self.last_next_state = next_state
+        self.last_done = done
+
+    def write_slot(self):
+        """ Return the arrays and the index the next experience is written to.
+        
+            INPUTS:
+            ------------
+                None
+                
+            OUTPUTS:
+            ------------
+                arrays - (tuple of numpy arrays) obs, actions, rewards, not_dones, gaps to write into
+                i - (int) index of the next experience in these arrays
+        
+        """
+        if not self.stage:
+            # The slot is overwritten, so an old gap in it no longer counts
+            self.n_gaps -= int(self.gaps_host[self.ptr])
+            return self.storage_np, self.ptr
+
+        # The last upload must have finished reading the staging block before it is refilled
+        if self.n_staged == 0:
+            self.upload_done.synchronize()
+        return self.staged_np, self.n_staged
+
+    def advance(self):
+        """ Move past the experience just written, uploading the staging block once it is full.
+        
+            INPUTS:
+            ------------
+                None
+                
+            OUTPUTS:
+            ------------
+                no direct
+        
+        """
+        if not self.stage:
+            self.n_gaps += int(self.gaps_host[self.ptr])
+            self.ptr = (self.ptr + 1) % self.buffer_size
+            self.size = min(self.size + 1, self.buffer_size)
+            return
+
+        self.n_staged += 1
+        if self.n_staged == self.block_size:
+            self.upload()
+
+    def upload(self):
+        """ Move the staged experiences into storage with one copy per field.
+        
+            INPUTS:
+            ------------
+                None
+                
+            OUTPUTS:
+            ------------
+                no direct
+        
+        """
+        n = self.n_staged
+        # Split the block where it wraps around the end of the storage,
+        # as (storage index, staged index, length) parts
+        first = min(n, self.buffer_size - self.ptr)
+        parts = ((self.ptr, 0, first), (0, first, n - first))
+        staged_gaps = self.staged_np[-1]
+        for dst, src, length in parts:
+            if length == 0:
+                continue
+            for buf, staged in zip(self.storage, self.staged):
+                # Experience i reads obs rows i and i + 1, so obs gets one extra row per part
+                extra = 1 if buf is self.obs else 0
+                buf[dst:dst + length + extra].copy_(staged[src:src + length + extra], non_blocking=True)
+
+            # Keep the host gap flags and the gap count in step with the storage
+            new_gaps = staged_gaps[src:src + length]
+            self.n_gaps += int(new_gaps.sum()) - int(self.gaps_host[dst:dst + length].sum())
+            self.gaps_host[dst:dst + length] = new_gaps
+        self.upload_done.record()
+
+        self.ptr = (self.ptr + n) % self.buffer_size
+        self.size = min(self.size + n, self.buffer_size)
+        self.n_staged = 0
     
+    def draw_indices(self):
+        """ Draw a batch of uniformly random storage slots, which may include gap slots.
+        
+            INPUTS:
+            ------------
+                None
+                
+            OUTPUTS:
+            ------------
+                idx - (torch tensor) int64 slot indices on the storage device
+        
+        """
+        if self.size == self.buffer_size:
+            # Skip the oldest experience, its state row now holds the newest next state
+            idx = torch.randint(0, self.size - 1, (self.batch_size,), device=self.store_device)
+            idx = (idx + self.ptr + 1) % self.buffer_size
+        else:
+            idx = torch.randint(0, self.size, (self.batch_size,), device=self.store_device)
+        return idx
+
     def sample(self):
         """ Randomly sample a batch of experiences from memory.
+            The returned tensors are reused, so they are only valid until the next call.
         
             INPUTS:
             ------------
@@ -216,18 +455,39 @@ class ReplayBuffer:
                 actions - (torch tensor) the agent's previous choice of actions
                 rewards - (torch tensor) last rewards received
                 next_states - (torch tensor) the next states of the environment
-                dones - (torch tensor) bools, whether the episode is complete (True or False)
+                not_dones - (torch tensor) uint8, 0 if the episode is complete, 1 otherwise
         
         """
-        experiences = random.sample(self.memory, k=self.batch_size)
+        idx = self.draw_indices()
+        # A gap slot holds no experience: redraw the indices that land on one
+        is_gap = self.gaps[idx].bool()
+        while is_gap.any():
+            idx = torch.where(is_gap, self.draw_indices(), idx)
+            is_gap = self.gaps[idx].bool()
+
+        # The previous transfer must have finished reading the batch tensors before they are refilled
+        if self.transfer_done is not None:
+            self.transfer_done.synchronize()
+
+        # Gather every field in one pass, without allocating new tensors
+        states, actions, rewards, next_states, not_dones = self.batch
+        torch.index_select(self.obs, 0, idx, out=states)
+        torch.index_select(self.actions, 0, idx, out=actions)
+        torch.index_select(self.rewards, 0, idx, out=rewards)
+        torch.index_select(self.obs, 0, idx + 1, out=next_states)
+        torch.index_select(self.not_dones, 0, idx, out=not_dones)
+
+        if self.store_device != device:
+            states, actions, rewards, next_states, not_dones = (
+                out.to(device, non_blocking=True) for out in self.batch)
+            if self.transfer_done is not None:
+                self.transfer_done.record()
 
-        states = torch.from_numpy(np.vstack([e.state for e in experiences if e is not None])).float().to(device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).long().to(device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(device)
-        next_states = torch.from_numpy(np.vstack([e.next_state for e in experiences if e is not None])).float().to(device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(device)
+        actions = actions.unsqueeze(1)
+        rewards = rewards.unsqueeze(1)
+        not_dones = not_dones.unsqueeze(1)
   
-        return (states, actions, rewards, next_states, dones)
+        return (states, actions, rewards, next_states, not_dones)
 
     def __len__(self):
         """ Return the current size of internal memory.
@@ -238,8 +498,8 @@ class ReplayBuffer:
                 
             OUTPUTS:
             ------------
-                mem_size - (int) current size of internal memory
+                mem_size - (int) number of experiences available for sampling
         
         """
-        mem_size = len(self.memory)
-        return mem_size
\ No newline at end of file
+        mem_size = self.size - self.n_gaps
+        return mem_size
@@ -40,7 +40,9 @@ class QNetwork(nn.Module):
         """
         x = F.relu(self.fc1(state))
         x = F.relu(self.fc2(x))
-        output = self.fc3(x)
+        # Output layer always in fp32, even under autocast, so close action values are not rounded
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            output = self.fc3(x.float())
         return output
 
        